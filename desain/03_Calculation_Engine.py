@@ -11,6 +11,8 @@ from typing import List, Dict, Optional, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 import json
+import time
+import uuid
 
 
 @dataclass
@@ -622,6 +624,564 @@ class CPLCalculationEngine:
         return conversion.get(grade, Decimal('0.00'))
 
 
+# =============================================================================
+# BULK RECALCULATION JOB (Resumable & Throttled)
+# =============================================================================
+
+class AdaptiveRateLimiter:
+    """
+    Throttles bulk recalculation to a units-per-second budget
+    One unit = one student or one enrollment (see RecalculationJob), not one row
+    Backs off when the database is busy (AIMD), so interactive grade entry
+    keeps priority over background recomputes
+    """
+    
+    MIN_UNIT_PER_DETIK = Decimal('0.5')
+    
+    def __init__(
+        self,
+        unit_per_detik: Decimal,
+        min_unit_per_detik: Optional[Decimal] = None,
+        maks_query_aktif: int = 10
+    ):
+        self.budget = Decimal(str(unit_per_detik))
+        if self.budget <= 0:
+            raise ValueError("unit_per_detik must be positive")
+        
+        if min_unit_per_detik is None:
+            min_unit_per_detik = self.MIN_UNIT_PER_DETIK
+        self.min_rate = min(Decimal(str(min_unit_per_detik)), self.budget)
+        self.maks_query_aktif = maks_query_aktif
+        self.current_rate = self.budget
+        self._next_allowed = time.monotonic()
+    
+    def acquire(self, units: int):
+        """Block until `units` units of work may be processed"""
+        now = time.monotonic()
+        if self._next_allowed > now:
+            time.sleep(self._next_allowed - now)
+            now = self._next_allowed
+        self._next_allowed = now + float(Decimal(units) / self.current_rate)
+    
+    def adjust(self, active_queries: int):
+        """
+        Adapt rate to DB load
+        - Busy (active queries > maks_query_aktif): halve rate, floored at min_rate
+        - Idle: grow 10% of budget, capped at budget
+        """
+        if active_queries > self.maks_query_aktif:
+            self.current_rate = max(self.current_rate / 2, self.min_rate)
+        else:
+            self.current_rate = min(self.current_rate + self.budget / 10, self.budget)
+
+
+class RecalculationJob:
+    """
+    Persistent bulk recalculation over all students or enrollments
+    
+    Progress is stored in job_perhitungan_cpl. Units are processed in
+    ascending id order up to `id_maksimum` (snapshot at job creation), and
+    `checkpoint_terakhir` holds the last id of the last committed batch, so
+    a crashed or paused job resumes with `WHERE id > checkpoint_terakhir`
+    instead of starting over.
+    
+    Scopes:
+    - 'mahasiswa': one unit = one student (recalculate_all_for_student)
+    - 'enrollment': one unit = one enrollment (recalculate_all_for_enrollment),
+      optionally filtered by mata_kuliah_id / semester_tahun / kelas
+      to recompute a single course section
+    
+    Concurrency:
+    A worker claims a job atomically (status → 'berjalan' + new worker_token)
+    and refreshes heartbeat_at at least every HEARTBEAT_DETIK, around each
+    throttle sleep. A 'berjalan' job whose heartbeat is older than
+    LEASE_DETIK is treated as crashed and may be reclaimed; the old worker
+    loses its token and stops at its next heartbeat.
+    
+    Transactions:
+    Each unit is committed on its own (recalculation is idempotent), and no
+    transaction is left open while throttling, so interactive grade entry
+    never waits on locks held by the job. The checkpoint stays per batch; a
+    batch interrupted midway is simply redone.
+    
+    Requires the connection to expose commit() and rollback().
+    """
+    
+    SCOPE_FILTERS = {
+        'mahasiswa': ('angkatan',),
+        'enrollment': ('mata_kuliah_id', 'semester_tahun', 'kelas'),
+    }
+    LEASE_DETIK = 600
+    HEARTBEAT_DETIK = 100
+    
+    def __init__(self, db_connection, engine: CPLCalculationEngine):
+        self.db = db_connection
+        self.engine = engine
+    
+    # -------------------------------------------------------------------------
+    # Job lifecycle
+    # -------------------------------------------------------------------------
+    
+    def create_job(
+        self,
+        jenis_cakupan: str = 'mahasiswa',
+        filter_cakupan: Optional[Dict] = None,
+        batch_size: int = 50,
+        unit_per_detik: Decimal = Decimal('20'),
+        maks_query_aktif: int = 10,
+        dibuat_oleh: Optional[int] = None
+    ) -> int:
+        """Register a new job and snapshot the units it covers"""
+        if jenis_cakupan not in self.SCOPE_FILTERS:
+            raise ValueError(f"Unknown job scope: {jenis_cakupan}")
+        
+        filter_cakupan = filter_cakupan or {}
+        unknown = set(filter_cakupan) - set(self.SCOPE_FILTERS[jenis_cakupan])
+        if unknown:
+            raise ValueError(
+                f"Unknown filter for scope '{jenis_cakupan}': {', '.join(sorted(unknown))}"
+            )
+        
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        if Decimal(str(unit_per_detik)) <= 0:
+            raise ValueError("unit_per_detik must be positive")
+        if maks_query_aktif <= 0:
+            raise ValueError("maks_query_aktif must be positive")
+        
+        # Longest single throttle sleep is one unit at the AIMD floor rate
+        min_rate = min(Decimal(str(unit_per_detik)), AdaptiveRateLimiter.MIN_UNIT_PER_DETIK)
+        if Decimal(1) / min_rate > Decimal(self.LEASE_DETIK) / 4:
+            raise ValueError(
+                f"unit_per_detik too low: one throttle sleep would exceed "
+                f"{self.LEASE_DETIK // 4}s of the {self.LEASE_DETIK}s lease"
+            )
+        
+        where, params = self._scope_filter(jenis_cakupan, filter_cakupan)
+        count_query = f"""
+            SELECT COUNT(*) AS total, MAX(id) AS id_maks
+            FROM {self._scope_table(jenis_cakupan)}
+            WHERE {where}
+        """
+        snapshot = self.db.execute_one(count_query, tuple(params))
+        
+        query = """
+            INSERT INTO job_perhitungan_cpl (
+                jenis_cakupan, filter_cakupan, status, batch_size,
+                unit_per_detik, maks_query_aktif, total_item, id_maksimum,
+                item_diproses, checkpoint_terakhir, durasi_detik,
+                dibuat_oleh, created_at
+            ) VALUES (%s, %s, 'menunggu', %s, %s, %s, %s, %s, 0, 0, 0, %s, NOW())
+            RETURNING id
+        """
+        job = self.db.execute_one(query, (
+            jenis_cakupan, json.dumps(filter_cakupan), batch_size,
+            unit_per_detik, maks_query_aktif, snapshot['total'],
+            snapshot['id_maks'] or 0, dibuat_oleh
+        ))
+        self.db.commit()
+        
+        return job['id']
+    
+    def pause_job(self, job_id: int) -> bool:
+        """
+        Request a pause; the runner stops at its next checkpoint and
+        releases its worker_token
+        """
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET status = 'dijeda', updated_at = NOW()
+            WHERE id = %s AND status IN ('menunggu', 'berjalan')
+            RETURNING id
+        """
+        paused = self.db.execute(query, (job_id,))
+        self.db.commit()
+        
+        return bool(paused)
+    
+    def resume_job(self, job_id: int, lewati_unit_gagal: bool = False) -> bool:
+        """
+        Re-queue a paused or failed job; a background worker picks it up
+        
+        If the job was paused but its runner is still alive and has not
+        reached the checkpoint yet (worker_token still set, lease fresh), the
+        pause is simply cancelled and that runner keeps going, so two workers
+        never own the job at once.
+        
+        lewati_unit_gagal: skip the unit that made the job fail, so a
+        deterministic error (missing row, bad data) does not block the job
+        
+        Returns False if the job was not paused/failed (e.g. still running).
+        """
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET status = CASE
+                    WHEN status = 'dijeda'
+                         AND worker_token IS NOT NULL
+                         AND heartbeat_at >= NOW() - make_interval(secs => %s)
+                    THEN 'berjalan'
+                    ELSE 'menunggu'
+                END,
+                pesan_error = NULL,
+                unit_dilewati = CASE
+                    WHEN %s AND unit_gagal IS NOT NULL
+                    THEN array_append(COALESCE(unit_dilewati, '{}'), unit_gagal)
+                    ELSE unit_dilewati
+                END,
+                unit_gagal = NULL,
+                updated_at = NOW()
+            WHERE id = %s AND status IN ('dijeda', 'gagal')
+            RETURNING id
+        """
+        requeued = self.db.execute(query, (self.LEASE_DETIK, lewati_unit_gagal, job_id))
+        self.db.commit()
+        
+        return bool(requeued)
+    
+    def run_next_job(self) -> Optional[int]:
+        """Background worker entry point: claim and run the oldest runnable job"""
+        job = self._claim_job()
+        if not job:
+            return None
+        
+        self._run_claimed(job)
+        return job['id']
+    
+    def run(self, job_id: int) -> bool:
+        """
+        Claim and run a specific job
+        Returns False if another worker holds it or it is not runnable
+        """
+        job = self._claim_job(job_id)
+        if not job:
+            return False
+        
+        self._run_claimed(job)
+        return True
+    
+    def get_job_status(self, job_id: int) -> Dict:
+        """
+        Get job progress and ETA
+        
+        ETA uses the average wall time per unit (throttling included)
+        across all runs of the job, so it survives pauses and restarts:
+        ETA = (total_item - item_diproses) × durasi_detik / item_diproses
+        """
+        query = """
+            SELECT *,
+                   (status = 'berjalan'
+                    AND heartbeat_at < NOW() - make_interval(secs => %s)) AS lease_kedaluwarsa
+            FROM job_perhitungan_cpl
+            WHERE id = %s
+        """
+        job = self.db.execute_one(query, (self.LEASE_DETIK, job_id))
+        
+        if not job:
+            raise ValueError(f"Recalculation job {job_id} not found")
+        
+        total = job['total_item'] or 0
+        processed = min(job['item_diproses'] or 0, total)
+        durasi = Decimal(str(job['durasi_detik'] or 0))
+        
+        # Units that left scope after the snapshot are never processed,
+        # so a finished job can have item_diproses < total_item
+        if job['status'] == 'selesai' or not total:
+            progress = Decimal('100.00')
+        else:
+            progress = (Decimal(processed) / Decimal(total) * 100).quantize(
+                self.engine.precision, ROUND_HALF_UP
+            )
+        
+        eta_detik = None
+        if job['status'] != 'selesai' and processed > 0:
+            remaining = total - processed
+            eta_detik = (Decimal(remaining) * durasi / Decimal(processed)).quantize(
+                Decimal('1'), ROUND_HALF_UP
+            )
+        
+        return {
+            'id': job['id'],
+            'status': job['status'],
+            'lease_kedaluwarsa': bool(job['lease_kedaluwarsa']),
+            'jenis_cakupan': job['jenis_cakupan'],
+            'total_item': total,
+            'item_diproses': processed,
+            'progress_persen': progress,
+            'checkpoint_terakhir': job['checkpoint_terakhir'],
+            'eta_detik': eta_detik,
+            'unit_gagal': job['unit_gagal'],
+            'unit_dilewati': job['unit_dilewati'] or [],
+            'pesan_error': job['pesan_error'],
+            'started_at': job['started_at'],
+            'heartbeat_at': job['heartbeat_at'],
+            'last_checkpoint_at': job['last_checkpoint_at'],
+            'finished_at': job['finished_at']
+        }
+    
+    # -------------------------------------------------------------------------
+    # Internals
+    # -------------------------------------------------------------------------
+    
+    def _claim_job(self, job_id: Optional[int] = None) -> Optional[Dict]:
+        """
+        Atomically take ownership of a job
+        Runnable: 'menunggu', or 'berjalan' with an expired lease (crashed worker)
+        """
+        target = "id = %s" if job_id is not None else "TRUE"
+        query = f"""
+            UPDATE job_perhitungan_cpl
+            SET status = 'berjalan',
+                worker_token = %s,
+                heartbeat_at = NOW(),
+                started_at = COALESCE(started_at, NOW()),
+                updated_at = NOW()
+            WHERE id = (
+                SELECT id
+                FROM job_perhitungan_cpl
+                WHERE {target}
+                  AND (status = 'menunggu'
+                       OR (status = 'berjalan'
+                           AND heartbeat_at < NOW() - make_interval(secs => %s)))
+                ORDER BY created_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        """
+        token = uuid.uuid4().hex
+        params = (token,) + ((job_id,) if job_id is not None else ()) + (self.LEASE_DETIK,)
+        job = self.db.execute_one(query, params)
+        self.db.commit()
+        
+        return job
+    
+    def _run_claimed(self, job: Dict):
+        """
+        Process remaining units batch by batch
+        
+        Each batch: read ids → commit → per unit (heartbeat → throttle →
+        heartbeat → recalculate → commit) → write checkpoint.
+        A failure rolls back the failing unit, records it in unit_gagal and
+        marks the job 'gagal'; the last committed checkpoint stays intact and
+        the batch is redone on resume.
+        """
+        job_id = job['id']
+        token = job['worker_token']
+        jenis_cakupan = job['jenis_cakupan']
+        filter_cakupan = self._load_filter(job['filter_cakupan'])
+        checkpoint = job['checkpoint_terakhir'] or 0
+        dilewati = set(job['unit_dilewati'] or [])
+        limiter = AdaptiveRateLimiter(
+            Decimal(str(job['unit_per_detik'])),
+            maks_query_aktif=job['maks_query_aktif']
+        )
+        last_heartbeat = time.monotonic()
+        
+        while True:
+            unit_ids = self._next_batch(
+                jenis_cakupan, filter_cakupan, checkpoint,
+                job['id_maksimum'], job['batch_size']
+            )
+            active_queries = self._active_query_count()
+            # Never sleep inside an open transaction
+            self.db.commit()
+            
+            if not unit_ids:
+                break
+            
+            # Wall time includes throttling so the ETA reflects the real pace
+            started = time.monotonic()
+            limiter.adjust(active_queries)
+            
+            for unit_id in unit_ids:
+                if unit_id in dilewati:
+                    continue
+                
+                last_heartbeat = self._heartbeat_if_due(job_id, token, last_heartbeat)
+                if last_heartbeat is None:
+                    print(f"⚠ Job {job_id} lease lost, another worker took over")
+                    return
+                
+                # Throttle per unit: one sleep is at most 1 / min_rate
+                limiter.acquire(1)
+                
+                last_heartbeat = self._heartbeat_if_due(job_id, token, last_heartbeat)
+                if last_heartbeat is None:
+                    print(f"⚠ Job {job_id} lease lost, another worker took over")
+                    return
+                
+                try:
+                    if jenis_cakupan == 'mahasiswa':
+                        self.engine.recalculate_all_for_student(unit_id)
+                    else:
+                        self.engine.recalculate_all_for_enrollment(unit_id)
+                    self.db.commit()
+                except Exception as e:
+                    self.db.rollback()
+                    self._mark_failed(job_id, token, unit_id, str(e))
+                    raise
+            
+            checkpoint = unit_ids[-1]
+            status = self._save_checkpoint(
+                job_id, token, checkpoint, len(unit_ids), time.monotonic() - started
+            )
+            last_heartbeat = time.monotonic()
+            
+            if status is None:
+                print(f"⚠ Job {job_id} lease lost, another worker took over")
+                return
+            if status == 'dijeda':
+                print(f"⏸ Job {job_id} paused at checkpoint {checkpoint}")
+                return
+        
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET status = 'selesai',
+                worker_token = NULL,
+                finished_at = NOW(),
+                updated_at = NOW()
+            WHERE id = %s AND worker_token = %s AND status = 'berjalan'
+        """
+        self.db.execute(query, (job_id, token))
+        self.db.commit()
+        print(f"✓ Recalculation job {job_id} complete")
+    
+    def _scope_table(self, jenis_cakupan: str) -> str:
+        return 'mahasiswa' if jenis_cakupan == 'mahasiswa' else 'enrollment'
+    
+    def _scope_filter(self, jenis_cakupan: str, filter_cakupan: Dict) -> Tuple[str, List]:
+        """Build WHERE clause for the job scope (column names are whitelisted)"""
+        if jenis_cakupan == 'mahasiswa':
+            conditions = ["status IN ('aktif', 'cuti', 'lulus')"]
+        else:
+            conditions = ["status IN ('lulus', 'aktif')"]
+        
+        params = []
+        for column in self.SCOPE_FILTERS[jenis_cakupan]:
+            if filter_cakupan.get(column) is not None:
+                conditions.append(f"{column} = %s")
+                params.append(filter_cakupan[column])
+        
+        return ' AND '.join(conditions), params
+    
+    def _load_filter(self, raw) -> Dict:
+        if not raw:
+            return {}
+        return json.loads(raw) if isinstance(raw, str) else raw
+    
+    def _next_batch(
+        self,
+        jenis_cakupan: str,
+        filter_cakupan: Dict,
+        checkpoint: int,
+        id_maksimum: int,
+        batch_size: int
+    ) -> List[int]:
+        """Keyset pagination: next `batch_size` ids after the checkpoint, within the snapshot"""
+        where, params = self._scope_filter(jenis_cakupan, filter_cakupan)
+        query = f"""
+            SELECT id
+            FROM {self._scope_table(jenis_cakupan)}
+            WHERE {where}
+              AND id > %s
+              AND id <= %s
+            ORDER BY id
+            LIMIT %s
+        """
+        rows = self.db.execute(query, tuple(params) + (checkpoint, id_maksimum, batch_size))
+        
+        return [row['id'] for row in rows]
+    
+    def _active_query_count(self) -> int:
+        """Current DB load: other client sessions of this database running queries"""
+        query = """
+            SELECT COUNT(*) AS aktif
+            FROM pg_stat_activity
+            WHERE state = 'active'
+              AND datname = current_database()
+              AND backend_type = 'client backend'
+              AND pid <> pg_backend_pid()
+        """
+        result = self.db.execute_one(query)
+        
+        return result['aktif'] if result else 0
+    
+    def _save_checkpoint(
+        self,
+        job_id: int,
+        token: str,
+        checkpoint: int,
+        jumlah: int,
+        durasi: float
+    ) -> Optional[str]:
+        """
+        Persist batch progress and refresh the heartbeat
+        Honouring a pause releases worker_token so the job can be re-queued.
+        Returns the job status, or None if this worker no longer owns the job
+        """
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET checkpoint_terakhir = %s,
+                item_diproses = item_diproses + %s,
+                durasi_detik = durasi_detik + %s,
+                worker_token = CASE WHEN status = 'dijeda' THEN NULL ELSE worker_token END,
+                heartbeat_at = NOW(),
+                last_checkpoint_at = NOW(),
+                updated_at = NOW()
+            WHERE id = %s AND worker_token = %s
+              AND status IN ('berjalan', 'dijeda')
+            RETURNING status
+        """
+        result = self.db.execute_one(query, (
+            checkpoint, jumlah,
+            Decimal(str(durasi)).quantize(Decimal('0.001'), ROUND_HALF_UP),
+            job_id, token
+        ))
+        
+        if not result:
+            # Lease lost: the new owner redoes this batch from the old checkpoint
+            self.db.rollback()
+            return None
+        
+        self.db.commit()
+        return result['status']
+    
+    def _heartbeat_if_due(self, job_id: int, token: str, last_heartbeat: float) -> Optional[float]:
+        """Heartbeat every HEARTBEAT_DETIK; returns the new timestamp, or None if the lease is lost"""
+        if time.monotonic() - last_heartbeat < self.HEARTBEAT_DETIK:
+            return last_heartbeat
+        if not self._heartbeat(job_id, token):
+            return None
+        return time.monotonic()
+    
+    def _heartbeat(self, job_id: int, token: str) -> bool:
+        """Extend the lease; False if this worker no longer owns the job"""
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET heartbeat_at = NOW(), updated_at = NOW()
+            WHERE id = %s AND worker_token = %s
+              AND status IN ('berjalan', 'dijeda')
+            RETURNING id
+        """
+        result = self.db.execute(query, (job_id, token))
+        self.db.commit()
+        
+        return bool(result)
+    
+    def _mark_failed(self, job_id: int, token: str, unit_id: Optional[int], pesan_error: str):
+        query = """
+            UPDATE job_perhitungan_cpl
+            SET status = 'gagal',
+                worker_token = NULL,
+                unit_gagal = %s,
+                pesan_error = %s,
+                updated_at = NOW()
+            WHERE id = %s AND worker_token = %s
+        """
+        self.db.execute(query, (unit_id, f"Unit {unit_id}: {pesan_error}", job_id, token))
+        self.db.commit()
+
+
 # =============================================================================
 # USAGE EXAMPLES
 # =============================================================================
@@ -651,6 +1211,13 @@ if __name__ == "__main__":
     # mahasiswa_id = 25010001
     # engine.recalculate_all_for_student(mahasiswa_id)
     
+    # Scenario 2b: Rekalkulasi massal seluruh mahasiswa (resumable)
+    # job_runner = RecalculationJob(db, engine)
+    # job_id = job_runner.create_job('mahasiswa', batch_size=50, unit_per_detik=Decimal('20'))
+    # job_runner.run_next_job()         # background worker loop
+    # job_runner.resume_job(job_id)     # after pause/failure → re-queued for the worker
+    # job_runner.get_job_status(job_id) # progress_persen, eta_detik
+    
     # Scenario 3: Get CPL dashboard data
     # cpl_data = db.execute("""
     #     SELECT * FROM v_student_cpl_dashboard